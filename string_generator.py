@@ -1,8 +1,20 @@
 #!/usr/bin/env python
 
-import random
-import argparse
-import string
+import os
+import sys
+import time
+import itertools
+
+# threading.local is _thread._local; importing it directly skips loading
+# the rest of threading (and functools and collections along with it).
+# Like threading, fall back to the pure-Python version where there's no
+# _thread._local.  threading, argparse, random, and the other heavier
+# modules are imported where they're used; see main() for why startup
+# time matters
+try:
+    from _thread import _local as _thread_local
+except ImportError:
+    from _threading_local import local as _thread_local
 
 ## @fn is_unfriendly()
 #  @brief returns true if the character is an unfriendly letter
@@ -162,6 +174,96 @@ def count(test_string, test_name):
     return n
 
 
+## @fn measure()
+#  @brief measure a string for any number of tests in a single pass
+#  @details
+#  For tests in the tests map (e.g., 'letters'), the measurement is the
+#  number of matching characters, just like count().  For tests in the
+#  structure_tests set (e.g., 'run'), the measurement is the longest
+#  stretch (or the most repeats) found anywhere in the string.  Either
+#  way, the string is only walked once, no matter how many tests are
+#  asked for.  Names that aren't tests are measured as 0.
+#  @param String test_string the string to measure
+#  @param List names the names of the tests (without 'min_' or 'max_')
+#  @returns Dict the test names mapped to their measurements
+#  @par Example
+#  @code
+#  print(measure ("Hello 123", ['letters', 'run', 'sequence']))
+#  # {'letters': 5, 'run': 2, 'sequence': 3}
+#  @endcode
+def measure(test_string, names):
+    values = dict((name, 0) for name in names)
+    counted = [name for name in values if name in tests]
+    structured = [name for name in values if name in structure_tests]
+    classes = {}
+    seen = {}
+    previous = None
+    run = sequence = direction = 0
+
+    for character in test_string:
+        matches = classes.get(character)
+        if matches is None:
+            matches = classes[character] = [
+                name for name in counted if tests[name](character)]
+        for name in matches:
+            values[name] += 1
+
+        if structured:
+            run = run + 1 if character == previous else 1
+            seen[character] = seen.get(character, 0) + 1
+            step = sequence_steps.get((previous, character), 0)
+            if sequence >= 2 and step & direction:
+                sequence, direction = sequence + 1, step & direction
+            elif step:
+                sequence, direction = 2, step
+            else:
+                sequence, direction = 1, 0
+            previous = character
+
+            if run > values.get('run', run):
+                values['run'] = run
+            if seen[character] > values.get('identical', seen[character]):
+                values['identical'] = seen[character]
+            if sequence > values.get('sequence', sequence):
+                values['sequence'] = sequence
+
+    return values
+
+
+## @fn longest_run()
+#  @brief returns the length of the longest run of one repeated character
+#  @par Example
+#  @code
+#  print(longest_run ("bookkeeper")) # 2
+#  @endcode
+def longest_run(test_string):
+    return measure(test_string, ['run'])['run']
+
+
+## @fn most_identical()
+#  @brief returns how many times the most common character appears
+#  @par Example
+#  @code
+#  print(most_identical ("banana")) # 3
+#  @endcode
+def most_identical(test_string):
+    return measure(test_string, ['identical'])['identical']
+
+
+## @fn longest_sequence()
+#  @brief returns the length of the longest sequence of characters
+#  @details
+#  A sequence is a stretch of characters that are next to each other
+#  in the alphabet, the digits, or along a row of the keyboard, going
+#  in one direction (e.g., 'abc', '321', 'qwerty').  See sequences.
+#  @par Example
+#  @code
+#  print(longest_sequence ("xabcd9")) # 4
+#  @endcode
+def longest_sequence(test_string):
+    return measure(test_string, ['sequence'])['sequence']
+
+
 ## @fn is_acceptable()
 #  @brief returns true if a given string passes all of its tests
 #  @details
@@ -174,6 +276,9 @@ def count(test_string, test_name):
 #  is interesting in that it counts the number of characters (defined as
 #  not None) which is the length of the string.  It seems obvious, but
 #  you never know when you'll need to come back to something like this..
+#  Structural tests (e.g., max_run=1) work the same way, except that
+#  what's compared is the measurement from measure().  All of the tests
+#  are measured together in one pass over the string.
 #  @param String test_string the string to test
 #  @param Dict kwargs a dictionary of test names and their values
 #  @returns Boolean False if any test fails; True, otherwise
@@ -182,20 +287,293 @@ def count(test_string, test_name):
 #  print is_acceptable ("Password", min_length=8, min_numbers=1) # False -- no numbers
 #  @endcode
 def is_acceptable(test_string, **kwargs):
+    checks = []
     if kwargs is not None:
-        for test, value in kwargs.iteritems():
-            if test.replace ('min_', '').replace ('max_', '') in tests and value != -1:
-                if test.startswith('min_'):
-                    if (count(test_string, test.replace ('min_', '')) < value):
-                        return False
-                if test.startswith('max_'):
-                    if (count(test_string, test.replace ('max_', '')) > value):
-                        return False
+        for test, value in kwargs.items():
+            name = test.replace ('min_', '').replace ('max_', '')
+            if (name in tests or name in structure_tests) and value != -1:
+                if test.startswith('min_') or test.startswith('max_'):
+                    checks.append((test, name, value))
+
+    values = measure(test_string, [name for test, name, value in checks])
+    for test, name, value in checks:
+        if test.startswith('min_'):
+            if (values[name] < value):
+                return False
+        if test.startswith('max_'):
+            if (values[name] > value):
+                return False
     return True
 
 
+## @class IncrementalValidator
+#  @brief is_acceptable(), but kept up to date one keystroke at a time
+#  @details
+#  This takes the same tests as is_acceptable(), but instead of scanning
+#  a whole string for each test, it keeps a running count for each kind
+#  of character.  Each time a character is typed (insert()) or erased
+#  (delete()), only that character is looked at, so keeping the counts
+#  current costs the same no matter how long the string is.  Since the
+#  counts don't care about order, the caller only has to tell us which
+#  character was added or removed, not where.  failures() lists the
+#  tests that the string currently fails, which is handy for telling a
+#  user what's missing (e.g., a strength meter).  Structural tests
+#  (see structure_tests) depend on where characters are, not just how
+#  many there are, so they aren't tracked here.
+#  @par Example
+#  @code
+#  v = IncrementalValidator (min_length=8, min_numbers=1)
+#  v.insert ('P')
+#  v.insert ('4')
+#  print(v.failures ()) # ['min_length']
+#  v.delete ('4')
+#  print(v.failures ()) # ['min_length', 'min_numbers']
+#  @endcode
+class IncrementalValidator(object):
+
+    def __init__(self, test_string='', **kwargs):
+        self.rules = []
+        for test, value in kwargs.items():
+            name = test.replace('min_', '').replace('max_', '')
+            if name in tests and value != -1 and (
+                    test.startswith('min_') or test.startswith('max_')):
+                self.rules.append((test, name, value))
+        self.rules.sort()
+
+        self.counts = dict((name, 0) for test, name, value in self.rules)
+        self._classes = {}
+        self.insert(test_string)
+
+    ## @fn _classify()
+    #  @brief return the names of the counted tests a character passes
+    def _classify(self, character):
+        names = self._classes.get(character)
+        if names is None:
+            names = self._classes[character] = tuple(
+                name for name in self.counts if tests[name](character))
+        return names
+
+    ## @fn insert()
+    #  @brief count one (or more) characters that were added to the string
+    def insert(self, characters):
+        counts = self.counts
+        for character in characters:
+            for name in self._classify(character):
+                counts[name] += 1
+
+    ## @fn delete()
+    #  @brief forget one (or more) characters that were removed from the string
+    def delete(self, characters):
+        counts = self.counts
+        for character in characters:
+            for name in self._classify(character):
+                counts[name] -= 1
+
+    ## @fn failures()
+    #  @brief return the names of the tests the string currently fails
+    def failures(self):
+        failed = []
+        for test, name, value in self.rules:
+            if test.startswith('min_'):
+                if self.counts[name] < value:
+                    failed.append(test)
+            elif self.counts[name] > value:
+                failed.append(test)
+        return failed
+
+    ## @fn is_acceptable()
+    #  @brief returns True if the string currently passes every test
+    def is_acceptable(self):
+        return not self.failures()
+
+
+#
+# entropy
+#
+
+
+# entropy is read from os.urandom() in blocks of this many machine words
+ENTROPY_BUFFER_WORDS = 1024
+
+# words are read straight out of the random bytes with memoryview.cast()
+_WORD_TYPECODE = 'I'
+_WORD_BYTES = memoryview(bytes(8)).cast(_WORD_TYPECODE).itemsize
+_WORD_BITS = _WORD_BYTES * 8
+_WORD_RANGE = 1 << _WORD_BITS
+_WORD_MASK = _WORD_RANGE - 1
+
+# bumped in the child after every fork(); a buffer filled in an earlier
+# generation holds words its parent may also use, so it's thrown away
+_fork_generation = 0
+
+
+def _after_fork_in_child():
+    global _fork_generation
+    _fork_generation += 1
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+## @class EntropyBuffer
+#  @brief a batched, cryptographically strong source of random integers
+#  @details
+#  Rather than asking the operating system for a few bytes of randomness
+#  every time we need a number (which is what random.SystemRandom does),
+#  we read a whole block of words from os.urandom() at once and hand them
+#  out one (or many) at a time.  When the block runs dry, we read another.
+#  Integers in a range are drawn with Lemire's multiply-and-shift method,
+#  rejecting the handful of words that would otherwise bias the result,
+#  so every value in the range is exactly as likely as every other.
+#
+#  An EntropyBuffer is NOT safe to share between threads; two threads
+#  could be handed the same words.  Use default_entropy() to get one
+#  that belongs to the calling thread.  It IS safe across fork(): the
+#  child throws away whatever words were buffered before the fork, so
+#  a parent and child never hand out the same ones.
+#  @par Example
+#  @code
+#  entropy = EntropyBuffer()
+#  die_roll = 1 + entropy.randbelow(6)
+#  @endcode
+class EntropyBuffer(object):
+
+    def __init__(self, size=ENTROPY_BUFFER_WORDS):
+        self.size = size
+        self._words = memoryview(b'').cast(_WORD_TYPECODE)
+        self._position = 0
+        self._generation = _fork_generation
+
+    ## @fn _refill()
+    #  @brief replace the buffer with at least n fresh words
+    def _refill(self, n):
+        self._words = memoryview(
+            os.urandom(max(n, self.size) * _WORD_BYTES)).cast(_WORD_TYPECODE)
+        self._position = 0
+        self._generation = _fork_generation
+
+    ## @fn word()
+    #  @brief return one random word (0 <= word < 2 ** _WORD_BITS)
+    def word(self):
+        if self._position >= len(self._words) or self._generation != _fork_generation:
+            self._refill(1)
+        w = self._words[self._position]
+        self._position += 1
+        return w
+
+    ## @fn words()
+    #  @brief return n random words (as a memoryview), read as a single batch
+    def words(self, n):
+        if self._position + n > len(self._words) or self._generation != _fork_generation:
+            self._refill(n)
+        start = self._position
+        self._position += n
+        return self._words[start:self._position]
+
+    ## @fn randbelow()
+    #  @brief return an unbiased random integer 0 <= value < bound
+    def randbelow(self, bound):
+        if bound > _WORD_RANGE:
+            import random
+            return random.SystemRandom().randrange(bound)
+        m = self.word() * bound
+        if (m & _WORD_MASK) < bound:
+            threshold = _WORD_RANGE % bound
+            while (m & _WORD_MASK) < threshold:
+                m = self.word() * bound
+        return m >> _WORD_BITS
+
+    ## @fn choice()
+    #  @brief return a random element from a non-empty sequence
+    def choice(self, sequence):
+        return sequence[self.randbelow(len(sequence))]
+
+    ## @fn fill()
+    #  @brief fill buf[0:n] with random elements of alphabet
+    #  @details
+    #  Like calling choice() n times, but the words are read as a single
+    #  batch.  The buffer and the alphabet must hold the same kind of
+    #  item (e.g., a bytearray and a bytes alphabet).
+    def fill(self, buf, n, alphabet):
+        bound = len(alphabet)
+        threshold = _WORD_RANGE % bound
+        words = self.words(n)
+        for i in range(n):
+            m = words[i] * bound
+            while (m & _WORD_MASK) < threshold:
+                m = self.word() * bound
+            buf[i] = alphabet[m >> _WORD_BITS]
+        return buf
+
+    ## @fn shuffle()
+    #  @brief shuffle a mutable buffer in place; see shuffle_buffer()
+    def shuffle(self, buf):
+        n = len(buf)
+        if n < 2:
+            return buf
+        if n > _WORD_RANGE:
+            raise ValueError('buffer is too large to shuffle')
+
+        # one swap index per position, all read in a single batch; the
+        # (rare) rejected words are replaced by single reads
+        words = self.words(n - 1)
+        k = 0
+        for i in range(n - 1, 0, -1):
+            bound = i + 1
+            m = words[k] * bound
+            k += 1
+            if (m & _WORD_MASK) < bound:
+                threshold = _WORD_RANGE % bound
+                while (m & _WORD_MASK) < threshold:
+                    m = self.word() * bound
+            j = m >> _WORD_BITS
+            buf[i], buf[j] = buf[j], buf[i]
+        return buf
+
+
+_local = _thread_local()
+
+
+## @fn default_entropy()
+#  @brief return the calling thread's EntropyBuffer
+#  @details
+#  Each thread gets its own buffer the first time it asks for one, so
+#  the module-level functions can be called from many threads at once
+#  without sharing (or locking) any random state.
+#  @returns EntropyBuffer the buffer belonging to the calling thread
+def default_entropy():
+    entropy = getattr(_local, 'entropy', None)
+    if entropy is None:
+        entropy = _local.entropy = EntropyBuffer()
+    return entropy
+
+
+## @fn shuffle_buffer()
+#  @brief shuffles a mutable buffer in place (Fisher-Yates)
+#  @details
+#  The buffer can be anything that supports len() and item assignment
+#  -- a bytearray, an array.array, or a list.  Nothing is allocated
+#  other than the batch of swap indices, so this is the shuffle to use
+#  when the same buffer gets shuffled over and over.
+#  @param Buffer buf the buffer to shuffle
+#  @param EntropyBuffer entropy where to get randomness (optional)
+#  @returns Buffer the same buffer, shuffled
+#  @par Example
+#  @code
+#  buf = bytearray(b'This is a test')
+#  shuffle_buffer (buf)
+#  @endcode
+def shuffle_buffer(buf, entropy=None):
+    if entropy is None:
+        entropy = default_entropy()
+    return entropy.shuffle(buf)
+
+
 ## @fn shuffle_string()
 #  @brief shuffles a given string
+#  @details
+#  ASCII strings (i.e., everything we generate) are shuffled as a
+#  bytearray; anything else falls back to a list of characters.
 #  @param String test_string the string to shuffle
 #  @returns String the shuffled string
 #  @par Example
@@ -203,18 +581,18 @@ def is_acceptable(test_string, **kwargs):
 #  scrambled = shuffle_string (unscrambled)
 #  @endcode
 def shuffle_string(test_string):
-    rng = random.SystemRandom()
-    l = list(test_string)
-    random.shuffle(l, rng.random)
-    return ''.join(l)
+    if test_string.isascii():
+        return shuffle_buffer(bytearray(test_string, 'ascii')).decode('ascii')
+    return ''.join(shuffle_buffer(list(test_string)))
 
 
 ## @fn system_random_range()
-#  @brief like random.randrange(), but with random.SystemRandom()
+#  @brief like random.randrange(), but with cryptographically strong randomness
 #  @details
 #  This is very supposed to be just like random.randrange() except
-#  we use random.SystemRandom() (instead of random.random()) for more
-#  crypto-friendly randomization.  Also, we don't use the step parameter
+#  we use the calling thread's EntropyBuffer (instead of random.random())
+#  for more crypto-friendly randomization.  Unlike randrange(), the
+#  maximum is included.  Also, we don't use the step parameter
 #  that randrange() uses.  Maybe in a future revision...
 #  @param Dict kwargs a dictionary of min and max values
 #  @returns Integer minimum <= value <= maximum
@@ -223,7 +601,6 @@ def shuffle_string(test_string):
 #  die_roll = system_random_range (min = 1, max = 6)
 #  @endcode
 def system_random_range (**kwargs):
-  rng = random.SystemRandom()
   if kwargs is not None:
     if 'min' in kwargs:
       n = kwargs['min']
@@ -236,22 +613,200 @@ def system_random_range (**kwargs):
       x = 1
 
   if n < x:
-    return n + round((x-n) * rng.random())
+    return n + default_entropy().randbelow(x - n + 1)
   else:
     return n
 
 
+# how many random picks _structured_fill() makes for a position before
+# listing the characters that are allowed there
+STRUCTURED_PICKS = 8
+
+
+## @class StringGenerator
+#  @brief a reusable, thread-safe generator for one set of tests
+#  @details
+#  Everything that can be worked out ahead of time -- the lengths, the
+#  alphabet, and which tests need checking -- is worked out once, when
+#  the generator is created, and never changed afterwards.  The only
+#  things that change while generating are the random numbers and the
+#  buffer the candidate is built in, and each thread gets its own of
+#  both (the thread's EntropyBuffer from default_entropy() and a scratch
+#  bytearray kept in a threading.local).  So a single generator can be
+#  shared by any number of threads without locks and without any thread
+#  ever seeing another's random numbers.
+#  @par Example
+#  @code
+#  passwords = StringGenerator (min_length=12, max_length=16, min_numbers=2)
+#  print(passwords.generate ())
+#  @endcode
+class StringGenerator(object):
+
+    def __init__(self, tries=500, **kwargs):
+        self.tries = tries
+        self.min_length = max(kwargs.get('min_length', 0), 0)
+        self.max_length = max(kwargs.get('max_length', 0), self.min_length)
+        # classes capped at 0 are left out rather than rejected later; that
+        # keeps every acceptable string exactly as likely as before
+        self.alphabet = large_alphabet(**kwargs).encode('ascii')
+        self.rules = tuple(
+            (_class_deletion(name), value, test.startswith('min_'))
+            for test, name, value in IncrementalValidator(**kwargs).rules)
+
+        # structural maximums are enforced while each candidate is built;
+        # anything else structural (e.g., a min_run) is checked afterwards
+        self.max_run = kwargs.get('max_run', -1)
+        self.max_identical = kwargs.get('max_identical', -1)
+        self.max_sequence = kwargs.get('max_sequence', -1)
+        self.structured = (self.max_run, self.max_identical, self.max_sequence) != (-1, -1, -1)
+        self.structure_checks = dict(
+            (test, value) for test, value in kwargs.items()
+            if test.replace('min_', '') in structure_tests
+            and test.startswith('min_') and value != -1)
+        self._steps = dict(
+            ((ord(a) << 8) | ord(b), step) for (a, b), step in sequence_steps.items())
+        self._local = _thread_local()
+
+    ## @fn _scratch()
+    #  @brief return the calling thread's scratch buffer
+    def _scratch(self):
+        buf = getattr(self._local, 'buf', None)
+        if buf is None:
+            buf = self._local.buf = bytearray(self.max_length)
+        return buf
+
+    ## @fn _candidate()
+    #  @brief build one candidate string (as bytes) in the scratch buffer
+    #  @returns Bytes the candidate; None if no candidate could be built
+    def _candidate(self, entropy, buf):
+        length = self.min_length
+        if self.max_length > length:
+            length += entropy.randbelow(self.max_length - length + 1)
+        if length and not self.alphabet:
+            return None
+        if self.structured:
+            if not self._structured_fill(entropy, buf, length):
+                return None
+        else:
+            entropy.fill(buf, length, self.alphabet)
+        return bytes(buf[:length])
+
+    ## @fn _structured_fill()
+    #  @brief fill buf[0:length] one character at a time, obeying max_run,
+    #  max_identical, and max_sequence
+    #  @details
+    #  Each position is picked at random from the alphabet; a pick that
+    #  would break one of the structural maximums (given the characters
+    #  before it) is thrown back and picked again.  Since only a handful
+    #  of characters are usually ruled out, that rarely takes more than
+    #  one pick.  If the first few picks are all thrown back, the
+    #  characters that are allowed at that position are listed and one
+    #  of those is picked instead, so a position with even one allowed
+    #  character never fails.  Either way, it's the same as picking
+    #  uniformly from only the allowed characters.  The bookkeeping is
+    #  the same as in measure().
+    #  @returns Boolean False if some position had no allowed character
+    def _structured_fill(self, entropy, buf, length):
+        alphabet = self.alphabet
+        size = len(alphabet)
+        steps = self._steps
+        max_run = self.max_run
+        max_identical = self.max_identical
+        max_sequence = self.max_sequence
+        seen = {}
+        previous = -1
+        run = sequence = direction = 0
+
+        # what run, seen, sequence, and direction become if character
+        # comes next; None if that would break one of the maximums
+        def follow(character):
+            new_run = run + 1 if character == previous else 1
+            if max_run != -1 and new_run > max_run:
+                return None
+            new_seen = seen.get(character, 0) + 1
+            if max_identical != -1 and new_seen > max_identical:
+                return None
+            step = steps.get((previous << 8) | character, 0)
+            if sequence >= 2 and step & direction:
+                new_sequence, new_direction = sequence + 1, step & direction
+            elif step:
+                new_sequence, new_direction = 2, step
+            else:
+                new_sequence, new_direction = 1, 0
+            if max_sequence != -1 and new_sequence > max_sequence:
+                return None
+            return new_run, new_seen, new_sequence, new_direction
+
+        for i in range(length):
+            for attempt in range(STRUCTURED_PICKS):
+                character = alphabet[entropy.randbelow(size)]
+                state = follow(character)
+                if state is not None:
+                    break
+            else:
+                allowed = [c for c in alphabet if follow(c) is not None]
+                if not allowed:
+                    return False
+                character = allowed[entropy.randbelow(len(allowed))]
+                state = follow(character)
+
+            buf[i] = previous = character
+            run, seen[character], sequence, direction = state
+
+        return True
+
+    ## @fn _is_acceptable()
+    #  @brief like is_acceptable(), but for a candidate built by _candidate()
+    def _is_acceptable(self, candidate):
+        if candidate is None:
+            return False
+        for deletion, value, is_min in self.rules:
+            n = len(candidate.translate(None, deletion))
+            if (n < value) if is_min else (n > value):
+                return False
+        if self.structure_checks:
+            return is_acceptable(candidate.decode('ascii'), **self.structure_checks)
+        return True
+
+    ## @fn generate_string()
+    #  @brief return one candidate string; see generate_string()
+    def generate_string(self):
+        candidate = self._candidate(default_entropy(), self._scratch())
+        if candidate is None:
+            return ''
+        return candidate.decode('ascii')
+
+    ## @fn generate()
+    #  @brief return an acceptable string; see generate_acceptable_string()
+    def generate(self):
+        entropy = default_entropy()
+        buf = self._scratch()
+        for i in range(self.tries):
+            candidate = self._candidate(entropy, buf)
+            if self._is_acceptable(candidate):
+                return candidate.decode('ascii')
+        return False
+
+    ## @fn __iter__()
+    #  @brief yield acceptable strings forever; see iter_acceptable_strings()
+    def __iter__(self):
+        generate = self.generate
+        while True:
+            generated_string = generate()
+            if generated_string is False:
+                return
+            yield generated_string
+
+
 ## @fn generate_string
 #  @brief given a series of tests, produce a string
 #  @details
-#  We start with an empty string.  Then, we go through the tests and
-#  add the minimum number of passing characters (for that test).  Then,
-#  we add a random number of characters to bring the length to be
-#  between minimum length <= actual length <= maximum length
-#  Finally, we shuffle the string and return it.  NOTE!  The returned
+#  We pick a length between minimum length <= actual length <= maximum
+#  length and fill it with random characters.  NOTE!  The returned
 #  string is NOT guaranteed to pass all of the tests -- this is only a
 #  starting guess.  The desired process is to use the
-#  generate_acceptable_string() function.
+#  generate_acceptable_string() function.  When generating many strings
+#  with the same tests, create a StringGenerator once and reuse it.
 #  @param Dict kwargs a dictionary of test names and their values
 #  @returns String a generated string
 #  @par Example
@@ -259,34 +814,7 @@ def system_random_range (**kwargs):
 #  possible_password = generate_string ('min_length': 8)
 #  @endcode
 def generate_string(**kwargs):
-    generated_string = ''
-    if kwargs is not None:
-        for character_class in kwargs.iteritems():
-            if character_class in character_classes:
-                generated_string += shuffle_string(
-                    character_classes[character_class])[0]
-
-        if 'min_length' in kwargs:
-          n = kwargs['min_length']
-        else:
-          n = 0
-
-
-        if 'max_length' in kwargs:
-          x = kwargs['max_length']
-        else:
-          x = 0
-
-        desired_length = system_random_range(min = n, max = x)
-
-        if desired_length == 0:
-            desired_length = n
-
-        while len(generated_string) < desired_length:
-          generated_string += shuffle_string(
-          character_classes['characters'])[0]
-
-    return shuffle_string(generated_string)
+    return StringGenerator(**kwargs).generate_string()
 
 
 ## @fn generate_acceptable_string()
@@ -298,23 +826,495 @@ def generate_string(**kwargs):
 #  unpassable tests (e.g., min_letters = 4 and max_length = 3), we
 #  break out and return False if too many tests fail.
 def generate_acceptable_string(**kwargs):
-    remaining_tries = 500
+    return StringGenerator(**kwargs).generate()
+
+
+## @fn iter_acceptable_strings()
+#  @brief yield acceptable strings, one after another, forever
+#  @details
+#  This is generate_acceptable_string() for when you need more than one:
+#  the tests are compiled into a StringGenerator once, up-front, and then
+#  each string costs only the generating and testing.  Nothing is
+#  collected in a list, so it can feed itertools.islice(), a file, or
+#  another generator directly.  If the tests can't be passed (i.e.,
+#  generate_acceptable_string() would return False), the iterator ends.
+#  @param Dict kwargs a dictionary of test names and their values
+#  @returns Iterator of acceptable strings
+#  @par Example
+#  @code
+#  for password in itertools.islice (iter_acceptable_strings (min_length=12), 100):
+#    print(password)
+#  @endcode
+def iter_acceptable_strings(**kwargs):
+    return iter(StringGenerator(**kwargs))
+
+
+#
+# large strings
+#
+
+
+# large strings are generated and counted this many bytes at a time
+LARGE_CHUNK_SIZE = 65536
+
+# large strings are expensive to throw away, so give up sooner
+LARGE_TRIES = 10
 
+_translations = {}
+_class_deletions = {}
+
+
+## @fn _translation()
+#  @brief return a byte translation table for an alphabet
+#  @details
+#  Random bytes are turned into characters with bytes.translate(): byte
+#  b becomes alphabet[b % len(alphabet)].  So that every character is
+#  equally likely, the top (256 % len(alphabet)) byte values -- the ones
+#  that would make the first few characters slightly more common -- are
+#  deleted instead of translated.
+#  @param String alphabet the characters to choose from
+#  @returns Tuple (table, deletions, accepted) for bytes.translate()
+def _translation(alphabet):
+    if alphabet not in _translations:
+        size = len(alphabet)
+        accepted = 256 - 256 % size
+        encoded = alphabet.encode('ascii')
+        table = bytes(bytearray(encoded[b % size] for b in range(256)))
+        deletions = bytes(bytearray(range(accepted, 256)))
+        _translations[alphabet] = (table, deletions, accepted)
+    return _translations[alphabet]
+
+
+## @fn _class_deletion()
+#  @brief return the bytes that do NOT pass a test (see count_bytes())
+def _class_deletion(name):
+    if name not in _class_deletions:
+        _class_deletions[name] = bytes(bytearray(
+            b for b in range(256) if b >= 128 or not tests[name](chr(b))))
+    return _class_deletions[name]
+
+
+## @fn count_bytes()
+#  @brief like count(), but for a chunk of ASCII bytes
+#  @details
+#  Rather than testing one character at a time, we delete every byte
+#  that doesn't pass the test (which happens in C) and count what's left.
+#  @param Bytes chunk the bytes to test
+#  @param String test_name the name of the test to perform on each byte
+#  @returns Integer the number of bytes in the chunk that match the test
+def count_bytes(chunk, test_name):
+    test = test_name.replace('min_', '').replace('max_', '')
+    return len(chunk.translate(None, _class_deletion(test)))
+
+
+## @fn random_bytes()
+#  @brief return n random characters from an alphabet, as bytes
+#  @param Integer n how many characters to return
+#  @param String alphabet the (ASCII) characters to choose from
+#  @returns Bytes the random characters
+def random_bytes(n, alphabet):
+    table, deletions, accepted = _translation(alphabet)
+    chunks = []
+    wanted = n
+    while wanted > 0:
+        # ask for enough bytes that, after deleting the rejects, we
+        # almost always have all we need in one go
+        chunk = os.urandom(wanted * 256 // accepted + 16).translate(table, deletions)
+        chunks.append(chunk[:wanted])
+        wanted -= len(chunks[-1])
+    if len(chunks) == 1:
+        return chunks[0]
+    return b''.join(chunks)
+
+
+## @fn large_alphabet()
+#  @brief return the characters a large string may be drawn from
+#  @details
+#  Any test whose maximum is 0 (e.g., max_unfriendly=0 for --friendly)
+#  rules out a whole class of characters; those characters are removed
+#  from the alphabet up-front so that megabytes of output aren't thrown
+#  away because of a single character.  StringGenerator uses the same
+#  alphabet, so short strings aren't thrown away for it either.
+#  @param Dict kwargs a dictionary of test names and their values
+#  @returns String the characters to choose from
+def large_alphabet(**kwargs):
+    alphabet = character_classes['characters']
+    for test, value in kwargs.items():
+        name = test.replace('max_', '')
+        if test.startswith('max_') and value == 0 and name in tests and name != 'length':
+            alphabet = ''.join(c for c in alphabet if not tests[name](c))
+    return alphabet
+
+
+## @fn stream_unsafe_tests()
+#  @brief return the tests a streamed large string might fail
+#  @details
+#  A streamed string can't be taken back, so any test that could still
+#  fail once it's been written is a problem.  Tests that can't fail are
+#  fine: the length (which is chosen up-front), maximums of 0 (those
+#  characters are left out of the alphabet; see large_alphabet()),
+#  minimums of 0 or less, and maximums no smaller than max_length.
+#  @param Dict kwargs a dictionary of test names and their values
+#  @returns List the names of the tests that might fail
+def stream_unsafe_tests(**kwargs):
+    longest = max(kwargs.get('min_length', 0), kwargs.get('max_length', 0))
+    unsafe = []
+    for test, value in sorted(kwargs.items()):
+        name = test.replace('min_', '').replace('max_', '')
+        if name not in tests or name == 'length' or value == -1:
+            continue
+        if test.startswith('min_') and value > 0:
+            unsafe.append(test)
+        elif test.startswith('max_') and 0 < value < longest:
+            unsafe.append(test)
+    return unsafe
+
+
+## @fn generate_large_string()
+#  @brief generate a very long acceptable string, in chunks
+#  @details
+#  This is for strings that are far too long for generate_string() and
+#  is_acceptable() to handle well (e.g., kilobytes to megabytes of key
+#  material or test data).  The string is generated LARGE_CHUNK_SIZE
+#  bytes at a time straight into a buffer that's allocated once, and
+#  the characters in each chunk are counted as it's generated, so the
+#  whole thing takes one pass.
+#
+#  If a stream is given, each chunk is written to it (as bytes) instead,
+#  so only one chunk is ever held in memory.  Since the string can't be
+#  taken back once it's written, the stream version doesn't retry; it
+#  returns False if what it wrote doesn't pass the tests.
+#
+#  Structural tests (e.g., max_run) can't be checked a chunk at a time,
+#  so they aren't supported here; a ValueError is raised if one is set.
+#  @param Stream stream a binary stream to write to (optional)
+#  @param Integer chunk_size how many bytes to generate at a time
+#  @param Dict kwargs a dictionary of test names and their values
+#  @returns String the generated string (or True if it was written to
+#  the stream); False if no acceptable string could be generated
+#  @par Example
+#  @code
+#  key = generate_large_string (min_length=1048576, max_length=1048576)
+#  generate_large_string (stream=sys.stdout.buffer, min_length=10485760)
+#  @endcode
+def generate_large_string(stream=None, chunk_size=LARGE_CHUNK_SIZE, **kwargs):
+    for test, value in kwargs.items():
+        if test.replace('min_', '').replace('max_', '') in structure_tests and value != -1:
+            raise ValueError("%s is not supported for large strings" % test)
+
+    n = kwargs.get('min_length', 0)
+    x = kwargs.get('max_length', 0)
+    alphabet = large_alphabet(**kwargs)
+
+    remaining_tries = 1 if stream is not None else LARGE_TRIES
     while remaining_tries > 0:
-        generated_string = generate_string(**kwargs)
-        if (is_acceptable(generated_string, **kwargs)):
-            return generated_string
         remaining_tries -= 1
 
+        desired_length = system_random_range(min = n, max = x)
+        if desired_length > 0 and not alphabet:
+            return False
+
+        validator = IncrementalValidator(**kwargs)
+        counts = validator.counts
+        if stream is None:
+            buf = bytearray(desired_length)
+
+        for start in range(0, desired_length, chunk_size):
+            chunk = random_bytes(min(chunk_size, desired_length - start), alphabet)
+            for name in counts:
+                counts[name] += count_bytes(chunk, name)
+            if stream is None:
+                buf[start:start + len(chunk)] = chunk
+            else:
+                stream.write(chunk)
+
+        if validator.is_acceptable():
+            if stream is None:
+                return buf.decode('ascii')
+            return True
+
     return False
 
 
 
+#
+# hashing
+#
+
+
+HASH_ALGORITHMS = ('pbkdf2_sha256', 'scrypt')
+DEFAULT_HASH_ALGORITHM = 'pbkdf2_sha256'
+
+# the default cost of each algorithm: iterations for PBKDF2, N for scrypt
+HASH_COSTS = {
+    'pbkdf2_sha256': 600000,
+    'scrypt': 16384
+}
+
+SALT_BYTES = 16
+
+
+## @fn hash_string()
+#  @brief hash a string with a random salt
+#  @details
+#  The hash is returned in a self-describing form -- the algorithm and
+#  its cost come first, e.g., 'pbkdf2_sha256$600000$<hex digest>' or
+#  'scrypt$16384$8$1$<hex digest>' -- so that it can be checked later
+#  even if the defaults change.  This is a plain module-level function
+#  so that it can be sent to worker processes (see hash_strings()).
+#  @param String plaintext the string to hash
+#  @param String algorithm one of HASH_ALGORITHMS
+#  @param Bytes salt the salt to use (default: SALT_BYTES random bytes)
+#  @param Integer cost iterations for PBKDF2, N for scrypt (optional)
+#  @returns Tuple (salt as hex, hash)
+#  @par Example
+#  @code
+#  salt, hashed = hash_string ('correct horse', 'scrypt')
+#  @endcode
+def hash_string(plaintext, algorithm=DEFAULT_HASH_ALGORITHM, salt=None, cost=None):
+    import hashlib
+
+    if salt is None:
+        salt = os.urandom(SALT_BYTES)
+    if cost is None:
+        cost = HASH_COSTS.get(algorithm)
+    secret = plaintext.encode('utf-8')
+
+    if algorithm == 'pbkdf2_sha256':
+        digest = hashlib.pbkdf2_hmac('sha256', secret, salt, cost)
+        hashed = '%s$%d$%s' % (algorithm, cost, digest.hex())
+    elif algorithm == 'scrypt':
+        digest = hashlib.scrypt(secret, salt=salt, n=cost, r=8, p=1,
+            maxmem=256 * 1024 * 1024, dklen=32)
+        hashed = '%s$%d$8$1$%s' % (algorithm, cost, digest.hex())
+    else:
+        raise ValueError("unknown hash algorithm '%s'" % algorithm)
+
+    return salt.hex(), hashed
+
+
+## @fn hash_strings()
+#  @brief hash a stream of strings across several processes
+#  @details
+#  Strings are pulled from the iterable one at a time and handed to a
+#  pool of worker processes to be hashed (hashing is slow on purpose,
+#  so this is where the time goes).  At most queue_size strings are in
+#  flight at once: once that many are waiting, we wait for the oldest
+#  to finish before pulling another.  That keeps every process busy
+#  while only ever holding a handful of plaintexts in memory, no matter
+#  how many strings there are.  Records come out in the same order the
+#  strings went in.
+#  @param Iterable strings the strings to hash
+#  @param String algorithm one of HASH_ALGORITHMS
+#  @param Integer cost iterations for PBKDF2, N for scrypt (optional)
+#  @param Integer processes how many worker processes (default: one per CPU)
+#  @param Integer queue_size how many strings may be in flight (default:
+#  four per process)
+#  @param Boolean include_plaintext False to leave the plaintext out of
+#  the records
+#  @returns Iterator of (plaintext or None, salt as hex, hash) tuples
+#  @par Example
+#  @code
+#  g = StringGenerator (min_length=16, max_length=16)
+#  strings = itertools.islice (g, 10000)
+#  write_records (hash_strings (strings, include_plaintext=False), sys.stdout)
+#  @endcode
+def hash_strings(strings, algorithm=DEFAULT_HASH_ALGORITHM, cost=None,
+        processes=None, queue_size=None, include_plaintext=True):
+    import collections
+    from concurrent.futures import ProcessPoolExecutor
+
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError("unknown hash algorithm '%s'" % algorithm)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if queue_size is None:
+        queue_size = 4 * processes
+
+    pending = collections.deque()
+    pool = ProcessPoolExecutor(processes)
+    try:
+        for plaintext in strings:
+            if len(pending) >= queue_size:
+                oldest, future = pending.popleft()
+                yield (oldest if include_plaintext else None,) + future.result()
+            pending.append((plaintext,
+                pool.submit(hash_string, plaintext, algorithm, None, cost)))
+
+        while pending:
+            oldest, future = pending.popleft()
+            yield (oldest if include_plaintext else None,) + future.result()
+    finally:
+        for plaintext, future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+## @fn write_records()
+#  @brief write (plaintext, salt, hash) records, one per line
+#  @details
+#  Fields are separated by tabs (which never appear in generated
+#  strings); an omitted plaintext is written as an empty field.  Each
+#  record is written as soon as it arrives.
+#  @param Iterable records (plaintext or None, salt, hash) tuples
+#  @param Stream stream a text stream to write to
+#  @returns Integer the number of records written
+def write_records(records, stream):
+    n = 0
+    for plaintext, salt, hashed in records:
+        stream.write('%s\t%s\t%s\n' % (plaintext or '', salt, hashed))
+        n += 1
+    return n
+
+
+#
+# reservoir
+#
+
+
+## @class StringReservoir
+#  @brief a queue of acceptable strings, kept topped up in the background
+#  @details
+#  Generating an acceptable string can take anywhere from one try to
+#  hundreds, depending on luck and on how strict the tests are.  When
+#  strings are needed on demand (e.g., handing out tokens), that
+#  unpredictability is better paid for ahead of time: a background
+#  thread keeps a queue of strings from a StringGenerator, and pop()
+#  just takes one off the front.
+#
+#  When the queue drops to low_water strings, the background thread
+#  wakes up and generates strings until there are high_water of them,
+#  then goes back to sleep.  If the queue is ever empty, pop() doesn't
+#  wait for the thread -- it generates a string itself (a "miss").
+#  stats() reports hits, misses, and how long refills take, which is
+#  what you need to pick the watermarks.
+#
+#  Strings come from a StringGenerator, which is thread-safe, so a
+#  reservoir can be popped from any number of threads.
+#  @par Example
+#  @code
+#  tokens = StringReservoir (StringGenerator (min_length=32, max_length=32))
+#  token = tokens.pop ()
+#  tokens.close ()
+#  @endcode
+class StringReservoir(object):
+
+    def __init__(self, generator, low_water=64, high_water=256):
+        if not 0 <= low_water < high_water:
+            raise ValueError("low_water must be at least 0 and less than high_water")
+        self.generator = generator
+        self.low_water = low_water
+        self.high_water = high_water
+
+        import collections
+        import threading
+        self._strings = collections.deque()
+        self._wanted = threading.Event()
+        self._closed = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_seconds = 0.0
+        self.max_refill_seconds = 0.0
+
+        self._thread = threading.Thread(target=self._refill,
+            name='StringReservoir')
+        self._thread.daemon = True
+        self._wanted.set()
+        self._thread.start()
+
+    ## @fn _refill()
+    #  @brief the background thread: fill up to high_water when asked
+    def _refill(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            if self._closed:
+                return
+
+            started = time.monotonic()
+            while len(self._strings) < self.high_water and not self._closed:
+                generated_string = self.generator.generate()
+                if generated_string is False:
+                    # the tests can't be passed; pop() will report it
+                    self._closed = True
+                    return
+                self._strings.append(generated_string)
+            elapsed = time.monotonic() - started
+
+            with self._lock:
+                self.refills += 1
+                self.refill_seconds += elapsed
+                self.max_refill_seconds = max(self.max_refill_seconds, elapsed)
+
+    ## @fn pop()
+    #  @brief return an acceptable string (False if the tests can't be passed)
+    def pop(self):
+        try:
+            generated_string = self._strings.popleft()
+            hit = True
+        except IndexError:
+            generated_string = self.generator.generate()
+            hit = False
+
+        if len(self._strings) <= self.low_water:
+            self._wanted.set()
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return generated_string
+
+    ## @fn stats()
+    #  @brief return counters describing how well the reservoir is keeping up
+    def stats(self):
+        with self._lock:
+            pops = self.hits + self.misses
+            return {
+                'size': len(self._strings),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / pops if pops else 1.0,
+                'refills': self.refills,
+                'mean_refill_seconds':
+                    self.refill_seconds / self.refills if self.refills else 0.0,
+                'max_refill_seconds': self.max_refill_seconds
+            }
+
+    ## @fn close()
+    #  @brief stop the background thread and discard any queued strings
+    def close(self):
+        self._closed = True
+        self._wanted.set()
+        self._thread.join()
+        self._strings.clear()
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 #
 # function maps
 #
 
 
+# the same as string.ascii_lowercase, etc.; they're spelled out here
+# because importing string also imports re, which is slow to load
+_ascii_lowercase = 'abcdefghijklmnopqrstuvwxyz'
+_ascii_uppercase = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_ascii_letters = _ascii_lowercase + _ascii_uppercase
+_digits = '0123456789'
+_punctuation = '!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'
+
 tests = {
     'letters': is_letter,
     'numbers': is_number,
@@ -325,41 +1325,318 @@ tests = {
     'unfriendly': is_unfriendly
 }
 
+# tests on where characters are rather than which ones; measure()
+# works all three out in the same pass as the counts, but longest_run(),
+# most_identical(), and longest_sequence() measure them one at a time
+structure_tests = set(['run', 'identical', 'sequence'])
+
+sequences = [
+    _ascii_lowercase,
+    _ascii_uppercase,
+    _digits,
+    '1234567890',
+    'qwertyuiop',
+    'asdfghjkl',
+    'zxcvbnm',
+    'QWERTYUIOP',
+    'ASDFGHJKL',
+    'ZXCVBNM'
+]
+
+## @fn _sequence_steps()
+#  @brief map (character, next character) to the directions of the step
+#  @details
+#  A pair can go forward through one sequence and backward through
+#  another (e.g., 'nm' in 'zxcvbnm' and in the alphabet), so the
+#  directions are bit flags: 1 for forward, 2 for backward, 3 for both.
+#  A sequence keeps going as long as each step shares a direction with
+#  the steps before it.
+#  @returns Dict the directions each pair steps through the sequences
+def _sequence_steps(sequences):
+    steps = {}
+    for sequence in sequences:
+        for a, b in zip(sequence, sequence[1:]):
+            steps[(a, b)] = steps.get((a, b), 0) | 1
+            steps[(b, a)] = steps.get((b, a), 0) | 2
+    return steps
+
+sequence_steps = _sequence_steps(sequences)
+
 character_classes = {
-    'letters': string.ascii_letters,
-    'numbers': string.digits,
-    'uppers': string.ascii_uppercase,
-    'lowers': string.ascii_lowercase,
-    'symbols': string.punctuation.replace('"', '').replace("'", ''),
-    'characters': string.ascii_letters + string.digits + string.punctuation.replace('"', '').replace("'", '').replace('`', '')
+    'letters': _ascii_letters,
+    'numbers': _digits,
+    'uppers': _ascii_uppercase,
+    'lowers': _ascii_lowercase,
+    'symbols': _punctuation.replace('"', '').replace("'", ''),
+    'characters': _ascii_letters + _digits + _punctuation.replace('"', '').replace("'", '').replace('`', '')
 }
 
 
+#
+# policy profiles
+#
+
+
+# bump this whenever the compiled form of a profile changes so that
+# caches written by older versions are ignored
+POLICY_CACHE_VERSION = 1
+
+# the options a profile may set (the same names as the command-line
+# options) and the type each one must have
+policy_options = {
+    'min_letters': int,
+    'max_letters': int,
+    'min_lowers': int,
+    'max_lowers': int,
+    'min_uppers': int,
+    'max_uppers': int,
+    'min_numbers': int,
+    'max_numbers': int,
+    'min_symbols': int,
+    'max_symbols': int,
+    'min_characters': int,
+    'max_characters': int,
+    'max_run': int,
+    'max_identical': int,
+    'max_sequence': int,
+    'friendly': bool
+}
+
+
+## @fn compile_profile()
+#  @brief validate one profile and return it as a dictionary of options
+#  @details
+#  A profile is a dictionary of command-line option names (without the
+#  leading dashes) and their values, e.g., {"min_characters": 16}.
+#  Unknown options and values of the wrong type are rejected with a
+#  ValueError rather than being silently ignored; min/max pairs that
+#  are backwards are swapped, just like main() does (a maximum of -1
+#  means "no maximum", so it's never swapped).
+#  @param String name the name of the profile (for error messages)
+#  @param Dict options the options in the profile
+#  @returns Dict the validated options
+#  @par Example
+#  @code
+#  compile_profile ('pin', {'min_numbers': 4, 'max_characters': 4})
+#  @endcode
+def compile_profile(name, options):
+    if not isinstance(options, dict):
+        raise ValueError("profile '%s' is not a table of options" % name)
+
+    compiled = {}
+    for option, value in options.items():
+        if option not in policy_options:
+            raise ValueError("profile '%s': unknown option '%s'" % (name, option))
+        # bool is a subclass of int, so check it explicitly
+        if (isinstance(value, bool) != (policy_options[option] is bool)
+                or not isinstance(value, policy_options[option])):
+            raise ValueError("profile '%s': option '%s' must be %s"
+                % (name, option, policy_options[option].__name__))
+        compiled[option] = value
+
+    for option in compiled:
+        if option.startswith('min_'):
+            other = option.replace('min_', 'max_')
+            if (other in compiled and compiled[other] != -1
+                    and compiled[option] > compiled[other]):
+                compiled[option], compiled[other] = compiled[other], compiled[option]
+
+    return compiled
+
+
+## @fn compile_policy()
+#  @brief validate every profile in a parsed policy file
+#  @details
+#  The policy is a dictionary with a 'profiles' key that maps profile
+#  names to profiles (see compile_profile()).
+#  @param Dict policy the parsed policy file
+#  @returns Dict profile names mapped to validated options
+def compile_policy(policy):
+    if not isinstance(policy, dict) or not isinstance(policy.get('profiles'), dict):
+        raise ValueError("policy must have a 'profiles' table")
+
+    compiled = {}
+    for name, options in policy['profiles'].items():
+        compiled[name] = compile_profile(name, options)
+    return compiled
+
+
+## @fn parse_policy()
+#  @brief parse the contents of a JSON or TOML policy file
+#  @details
+#  Files whose names end with '.toml' are parsed as TOML (which needs
+#  Python 3.11's tomllib); everything else is parsed as JSON.
+#  @param String path the name of the policy file
+#  @param Bytes data the contents of the policy file
+#  @returns Dict the parsed (but not yet validated) policy
+def parse_policy(path, data):
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError("reading TOML policies requires Python 3.11 or newer")
+        try:
+            return tomllib.loads(data.decode('utf-8'))
+        except tomllib.TOMLDecodeError as e:
+            raise ValueError("%s: %s" % (path, e))
+
+    import json
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError as e:
+        raise ValueError("%s: %s" % (path, e))
+
+
+## @fn policy_cache_dir()
+#  @brief return the directory where compiled policies are cached
+#  @details
+#  This is $STRING_GENERATOR_CACHE if it's set; otherwise, it's a
+#  'string_generator' directory under $XDG_CACHE_HOME (or ~/.cache).
+#  @returns String the name of the cache directory
+def policy_cache_dir():
+    if os.environ.get('STRING_GENERATOR_CACHE'):
+        return os.environ['STRING_GENERATOR_CACHE']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'string_generator')
+
+
+## @fn _private_cache_dir()
+#  @brief make sure the policy cache directory is ours alone
+#  @details
+#  The cache directory is created with mode 0700 if it doesn't exist.
+#  A directory owned by someone else, or one that others can write to,
+#  is not trusted: someone could plant a cache file with a weaker
+#  policy in it.  (On platforms without os.getuid(), such as Windows,
+#  only the creation is done.)
+#  @param String cache_dir the policy cache directory
+#  @returns Boolean True if the cache directory may be used
+def _private_cache_dir(cache_dir):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    if not hasattr(os, 'getuid'):
+        return True
+    info = os.stat(cache_dir)
+    return info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+
+## @fn load_policy()
+#  @brief load and compile a policy file, using the on-disk cache
+#  @details
+#  The contents of the policy file are hashed and the hash is used as
+#  the name of the cached, compiled policy.  If that cache exists, it's
+#  loaded as-is and no parsing or validation happens; if not, the file
+#  is parsed, compiled, and the result is written to the cache for next
+#  time.  Since the cache is keyed by the contents of the file, editing
+#  the file (or copying a new one into place) is all it takes to
+#  invalidate it.  Problems reading or writing the cache are ignored --
+#  the cache only ever makes things faster, never different.  The
+#  cache is skipped entirely unless its directory is private (see
+#  _private_cache_dir()), and cache files owned by anyone else are
+#  ignored.
+#  @param String path the name of the policy file
+#  @param String cache_dir where to cache compiled policies (optional)
+#  @returns Dict profile names mapped to validated options
+#  @par Example
+#  @code
+#  profiles = load_policy ('/etc/string_generator.json')
+#  print(generate_acceptable_string (**profile_kwargs (profiles['pin'])))
+#  @endcode
+def load_policy(path, cache_dir=None):
+    import hashlib
+    import marshal
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if cache_dir is None:
+        cache_dir = policy_cache_dir()
+    digest = hashlib.sha256(data).hexdigest()
+    cache_file = os.path.join(cache_dir,
+        'policy-%d-%s.bin' % (POLICY_CACHE_VERSION, digest))
+
+    try:
+        private = _private_cache_dir(cache_dir)
+    except OSError:
+        private = False
+
+    if private:
+        try:
+            with open(cache_file, 'rb') as f:
+                if hasattr(os, 'getuid') and os.fstat(f.fileno()).st_uid != os.getuid():
+                    raise OSError('cache file is not ours')
+                compiled = marshal.load(f)
+            if isinstance(compiled, dict):
+                return compiled
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    compiled = compile_policy(parse_policy(path, data))
+
+    if private:
+        temp_file = None
+        try:
+            import tempfile
+            fd, temp_file = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(compiled, f)
+            os.replace(temp_file, cache_file)
+        except OSError:
+            if temp_file is not None:
+                try:
+                    os.remove(temp_file)
+                except OSError:
+                    pass
+
+    return compiled
+
+
+## @fn profile_kwargs()
+#  @brief turn a profile's options into generate_acceptable_string() arguments
+#  @details
+#  Profiles use the command-line option names; this maps them onto the
+#  test names used by generate_acceptable_string() and is_acceptable()
+#  the same way main() does.
+#  @param Dict options a compiled profile
+#  @returns Dict keyword arguments for generate_acceptable_string()
+def profile_kwargs(options):
+    kwargs = {}
+    for option, value in options.items():
+        if option == 'friendly':
+            continue
+        kwargs[option.replace('characters', 'length')] = value
+
+    kwargs['min_length'] = kwargs.get('min_length', 8)
+    kwargs['max_length'] = kwargs.get('max_length', 16)
+    kwargs['min_unfriendly'] = 0
+    kwargs['max_unfriendly'] = 0 if options.get('friendly') else kwargs['max_length']
+    return kwargs
+
+
 #
 # main function
 #
 
 
-def main():
+## @fn build_parser()
+#  @brief return the argument parser for the command line
+def build_parser():
+  import argparse
 
   parser = argparse.ArgumentParser(
       description="This tool is used to generate random strings such as "
       "those used as passwords.  A number of parameters are accepted that "
       "can be used to specify minimum and maximum numbers of uppercase "
       "letters, lowercase letters, numbers, symbols (punctuation), and "
-      "characters (i.e., string length)."
-      ""
-      "To generate a string, the minimums for each character type are "
-      "put together along with enough random characters to put the total "
-      "length between the minimum and maximum lengths.  The string is "
-      "then shuffled.  If the string passes all of the tests for minimum "
-      "and maximum counts, the string is written to STDOUT.  If the it "
-      "doesn't, then a new random string is generated.  If the tool is "
-      "not able to generate an acceptable string after 100 tries, then "
-      "the tool aborts and returns an result code of 1 with no string "
-      "returned, the assumption being that the parameters provided are "
-      "somehow in conflict (e.g., minimum letters = 4 and maximum length "
-      "= 3)."
+      "characters (i.e., string length).  "
+      "To generate a string, a length between the minimum and maximum "
+      "lengths is picked and filled with random characters.  If the "
+      "string passes all of the tests for minimum and maximum counts, "
+      "the string is written to STDOUT.  If it doesn't, then a new random "
+      "string is generated.  If the tool is not able to generate an "
+      "acceptable string after 500 tries, then it gives up, the "
+      "assumption being that the parameters provided are somehow in "
+      "conflict (e.g., minimum letters = 4 and maximum length = 3)."
   )
 
   parser.add_argument(
@@ -444,57 +1721,185 @@ def main():
       default=16
   )
 
+  parser.add_argument("--max_run", "-r",
+      help="maximum number of identical characters in a row "
+      "(1 means no character is repeated next to itself)",
+      type=int,
+      default=-1
+  )
+
+  parser.add_argument("--max_identical", "-i",
+      help="maximum number of times any one character may appear",
+      type=int,
+      default=-1
+  )
+
+  parser.add_argument("--max_sequence", "-q",
+      help="maximum length of alphabet, digit, or keyboard sequences "
+      "(e.g., 2 allows 'ab' but not 'abc', '321', or 'qwe')",
+      type=int,
+      default=-1
+  )
+
   parser.add_argument("--friendly", "-f",
       help="make sure string is human-friendly (no ambiguous characters)",
       action="store_true"
   )
 
+  parser.add_argument("--stream",
+      help="write the string to STDOUT in chunks as it's generated "
+      "(for very long strings, e.g., megabytes); only length and "
+      "max_* = 0 tests are allowed, and not with --count or --hash",
+      action="store_true"
+  )
+
+  parser.add_argument("--count", "-k",
+      help="how many strings to generate, one per line",
+      type=int,
+      default=1
+  )
+
+  parser.add_argument("--hash",
+      help="hash each string (with a random salt) and write "
+      "'plaintext<TAB>salt<TAB>hash' lines instead",
+      choices=HASH_ALGORITHMS
+  )
+
+  parser.add_argument("--omit_plaintext",
+      help="with --hash, leave the plaintext field empty",
+      action="store_true"
+  )
+
+  parser.add_argument("--processes",
+      help="with --hash, how many processes to hash with "
+      "(default: one per CPU)",
+      type=int
+  )
+
+  parser.add_argument("--profile", "-P",
+      help="use the options from the named profile in the policy file; "
+      "options given on the command line override the profile"
+  )
+
+  parser.add_argument("--policy_file", "-p",
+      help="JSON or TOML file of named profiles "
+      "(default: $STRING_GENERATOR_POLICY)",
+      default=os.environ.get('STRING_GENERATOR_POLICY')
+  )
+
+  return parser
+
+
+## @fn main()
+#  @brief the command line tool
+#  @details
+#  The tool is often run thousands of times in a row (e.g., by
+#  configuration management), so for a single string, starting Python
+#  and loading modules costs more than generating the string does.  To
+#  keep that down, nothing heavier than what generating needs is
+#  imported up-front, and when there are no options at all (the most
+#  common case) we skip building the argument parser entirely and use
+#  the defaults directly.  test_import_time checks that this stays
+#  fast.  Running the tool as 'python -m string_generator' also lets
+#  Python reuse the compiled module instead of compiling it every time.
+def main():
+
+  if len(sys.argv) == 1:
+    print(StringGenerator(**profile_kwargs({})).generate())
+    return
+
+  parser = build_parser()
+
+  # a profile only changes the defaults, so find out which one (if any)
+  # was asked for before parsing everything else
+
+  args, unparsed = parser.parse_known_args()
+
+  if args.profile is not None:
+    if args.policy_file is None:
+      parser.error("--profile requires --policy_file or $STRING_GENERATOR_POLICY")
+    try:
+      profiles = load_policy(args.policy_file)
+    except (OSError, ValueError) as e:
+      parser.error(str(e))
+    if args.profile not in profiles:
+      parser.error("profile '%s' not found in %s" % (args.profile, args.policy_file))
+    parser.set_defaults(**profiles[args.profile])
+
   args = parser.parse_args()
 
+  if args.count < 0:
+    parser.error("--count must be 0 or more")
+  if args.processes is not None and args.processes < 1:
+    parser.error("--processes must be 1 or more")
+
   # make sure the minimum values are the smaller of the two and the
-  # maximum values are the larger of the two.
+  # maximum values are the larger of the two.  A maximum of -1 means
+  # "no maximum", so a minimum on its own is left alone.
 
-  if args.min_letters > args.max_letters:
+  if args.max_letters != -1 and args.min_letters > args.max_letters:
     args.min_letters, args.max_letters = args.max_letters, args.min_letters
 
-  if args.min_uppers > args.max_uppers:
+  if args.max_uppers != -1 and args.min_uppers > args.max_uppers:
     args.min_uppers, args.max_uppers = args.max_uppers, args.min_uppers
 
-  if args.min_lowers > args.max_lowers:
+  if args.max_lowers != -1 and args.min_lowers > args.max_lowers:
     args.min_lowers, args.max_lowers = args.max_lowers, args.min_lowers
 
-  if args.min_numbers > args.max_numbers:
+  if args.max_numbers != -1 and args.min_numbers > args.max_numbers:
     args.min_numbers, args.max_numbers = args.max_numbers, args.min_numbers
 
-  if args.min_symbols > args.max_symbols:
+  if args.max_symbols != -1 and args.min_symbols > args.max_symbols:
     args.min_symbols, args.max_symbols = args.max_symbols, args.min_symbols
 
   if args.min_characters > args.max_characters:
     args.min_characters, args.max_characters = args.max_characters, args.min_characters
 
 
-  print generate_acceptable_string(
-      min_letters=args.min_letters,
-      max_letters=args.max_letters,
-
-      min_uppers=args.min_uppers,
-      max_uppers=args.max_uppers,
-
-      min_lowers=args.min_lowers,
-      max_lowers=args.max_lowers,
-
-      min_numbers=args.min_numbers,
-      max_numbers=args.max_numbers,
-
-      min_symbols=args.min_symbols,
-      max_symbols=args.max_symbols,
-
-      min_length=args.min_characters,
-      max_length=args.max_characters,
-
-      min_unfriendly=0,
-      max_unfriendly=0 if args.friendly else args.max_characters
-  )
+  kwargs = profile_kwargs(
+      dict((option, getattr(args, option)) for option in policy_options))
+
+  if args.stream:
+    # --stream writes exactly one plaintext string
+    for option, given in (('--count', args.count != 1), ('--hash', args.hash),
+        ('--omit_plaintext', args.omit_plaintext), ('--processes', args.processes)):
+      if given:
+        parser.error("--stream can't be used with %s" % option)
+    # once it's written, a streamed string can't be retried, so refuse
+    # tests that could fail rather than print a string that breaks them
+    unsafe = stream_unsafe_tests(**kwargs)
+    if unsafe:
+      parser.error("--stream can't guarantee %s; use a maximum of 0 or "
+          "leave them out" % ', '.join(unsafe))
+    sys.stdout.flush()
+    try:
+      acceptable = generate_large_string(stream=sys.stdout.buffer, **kwargs)
+    except ValueError as e:
+      parser.error(str(e))
+    sys.stdout.buffer.write(b'\n')
+    if not acceptable:
+      sys.stdout.flush()
+      parser.error("the streamed string does not pass all of the tests")
+    return
+
+  generator = StringGenerator(**kwargs)
+
+  if args.hash is None:
+    for i in range(args.count):
+      generated_string = generator.generate()
+      if generated_string is False:
+        sys.stdout.flush()
+        parser.error("unable to generate an acceptable string")
+      print(generated_string)
+    return
+
+  written = write_records(hash_strings(
+      itertools.islice(generator, args.count), args.hash,
+      processes=args.processes,
+      include_plaintext=not args.omit_plaintext), sys.stdout)
+
+  if written < args.count:
+    parser.error("unable to generate an acceptable string")
 
 if __name__ == '__main__':
     main()
@@ -5,6 +5,16 @@
 #  @brief perform unit tests on string_generator.py
 
 
+import io
+import os
+import sys
+import subprocess
+import hashlib
+import array
+import threading
+import time
+import itertools
+
 import pytest
 from string_generator import *
 
@@ -267,6 +277,106 @@ def test_is_acceptable9():
   ) == False
 
 
+def test_incremental_validator1():
+  v = IncrementalValidator(min_length=8, min_numbers=1)
+
+  assert v.failures() == ['min_length', 'min_numbers']
+
+def test_incremental_validator2():
+  v = IncrementalValidator('ThisIsTest#1', min_length=8, min_numbers=1, max_symbols=1)
+
+  assert v.is_acceptable() == True
+
+def test_incremental_validator3():
+  v = IncrementalValidator('ThisIsTest#1', min_length=8, max_symbols=1)
+  v.insert('!')
+
+  assert v.failures() == ['max_symbols']
+
+def test_incremental_validator4():
+  v = IncrementalValidator('ThisIsTest#1', min_length=8, max_symbols=1)
+  v.insert('!')
+  v.delete('#')
+
+  assert v.is_acceptable() == True
+
+def test_incremental_validator5():
+  v = IncrementalValidator(min_numbers=-1, max_numbers=-1)
+
+  assert v.rules == []
+
+def test_incremental_validator6():
+  kwargs = dict(min_letters=4, max_uppers=3, min_lowers=2, max_numbers=1,
+    min_symbols=1, min_length=8, max_unfriendly=2)
+  v = IncrementalValidator(**kwargs)
+  typed = ''
+  for character in 'ThisIsTest#1!' + 'abc':
+    typed += character
+    v.insert(character)
+    assert v.is_acceptable() == is_acceptable(typed, **kwargs)
+  while typed:
+    v.delete(typed[-1])
+    typed = typed[:-1]
+    assert v.is_acceptable() == is_acceptable(typed, **kwargs)
+
+
+def test_measure1():
+  assert measure('Hello 123', ['letters', 'run', 'sequence']) == {
+    'letters': 5, 'run': 2, 'sequence': 3}
+
+def test_measure2():
+  assert measure('', ['run', 'identical', 'sequence', 'length']) == {
+    'run': 0, 'identical': 0, 'sequence': 0, 'length': 0}
+
+def test_longest_run1():
+  assert longest_run('bookkeeper') == 2
+
+def test_longest_run2():
+  assert longest_run('aaab') == 3
+
+def test_most_identical1():
+  assert most_identical('banana') == 3
+
+def test_longest_sequence1():
+  assert longest_sequence('xabcd9') == 4
+
+def test_longest_sequence2():
+  assert longest_sequence('9876') == 4
+
+def test_longest_sequence3():
+  assert longest_sequence('qwerty') == 6
+
+def test_longest_sequence4():
+  assert longest_sequence('aba') == 2
+
+def test_longest_sequence5():
+  assert longest_sequence('a1b2') == 1
+
+def test_longest_sequence6():
+  assert longest_sequence('bnm') == 3
+
+def test_longest_sequence7():
+  assert longest_sequence('BNM') == 3
+
+def test_longest_sequence8():
+  assert longest_sequence('mnb') == 3
+
+def test_is_acceptable10():
+  assert is_acceptable('Passw0rd!', max_run=1) == False
+
+def test_is_acceptable11():
+  assert is_acceptable('Pasw0rd!', max_run=1, max_sequence=2, max_identical=1) == True
+
+def test_is_acceptable12():
+  assert is_acceptable('Xabc#123', max_sequence=2) == False
+
+def test_is_acceptable13():
+  assert is_acceptable('Xabc#123', max_sequence=-1, min_letters=4) == True
+
+def test_is_acceptable14():
+  assert is_acceptable('Xbnm#7Qz', max_sequence=2) == False
+
+
 def test_generate_string1():
   assert generate_string() == ''
 
@@ -306,6 +416,363 @@ def test_generate_acceptable_string7():
   assert len(s) >= 8
 
 
+def test_string_generator1():
+  g = StringGenerator(min_length=8, max_length=12, min_numbers=2, max_unfriendly=0)
+  for i in range(100):
+    s = g.generate()
+    assert 8 <= len(s) <= 12
+    assert is_acceptable(s, min_numbers=2, max_unfriendly=0)
+
+def test_string_generator2():
+  assert StringGenerator(min_length=3, max_length=3, min_letters=4).generate() == False
+
+def test_string_generator3():
+  assert StringGenerator().generate() == ''
+
+def test_string_generator4():
+  g = StringGenerator(min_length=16, max_length=16, min_symbols=1)
+  results = []
+  buffers = []
+  def work():
+    buffers.append(g._scratch())
+    results.extend(g.generate() for i in range(200))
+  threads = [threading.Thread(target=work) for i in range(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+  assert len(results) == 1600
+  assert len(set(results)) == 1600
+  assert all(is_acceptable(s, min_length=16, min_symbols=1) for s in results)
+  assert len(set(id(b) for b in buffers)) == 8
+
+def test_string_generator5():
+  g = StringGenerator(min_length=10, max_length=10)
+
+  assert len(g.generate_string()) == 10
+
+
+def test_string_generator6():
+  g = StringGenerator(min_length=40, max_length=40, max_run=1, max_sequence=2)
+  for i in range(200):
+    s = g.generate()
+    assert longest_run(s) <= 1 and longest_sequence(s) <= 2
+
+def test_string_generator7():
+  g = StringGenerator(min_length=60, max_length=60, max_identical=1)
+  s = g.generate()
+
+  assert len(s) == 60 and most_identical(s) == 1
+
+def test_string_generator8():
+  n = len(character_classes['characters'])
+  g = StringGenerator(min_length=n + 1, max_length=n + 1, max_identical=1)
+
+  assert g.generate() == False
+
+def test_string_generator9():
+  g = StringGenerator(min_length=20, max_length=20, max_sequence=1, min_numbers=3)
+  s = g.generate()
+
+  assert is_acceptable(s, max_sequence=1, min_numbers=3)
+
+def test_string_generator10():
+  g = StringGenerator(min_length=20, max_length=20, max_run=2, min_run=2)
+  s = g.generate()
+
+  assert longest_run(s) == 2
+
+class ScriptedEntropy:
+  # picks the characters it's given, in order
+  def __init__(self, characters):
+    self.characters = list(characters)
+
+  def randbelow(self, n):
+    return character_classes['characters'].index(self.characters.pop(0))
+
+def test_string_generator11():
+  for characters, expected in (('bnmx', 'bnx'), ('BNMX', 'BNX'), ('mnbx', 'mnx')):
+    g = StringGenerator(min_length=3, max_length=3, max_sequence=2)
+    buf = bytearray(3)
+
+    assert g._structured_fill(ScriptedEntropy(characters), buf, 3)
+    assert buf == expected.encode('ascii')
+
+def test_string_generator12():
+  g = StringGenerator(min_length=64, max_length=64, max_unfriendly=0)
+
+  assert all(is_acceptable(g.generate(), max_unfriendly=0) for i in range(20))
+
+def test_string_generator13():
+  g = StringGenerator(min_length=6, max_length=6, max_letters=0, max_symbols=0)
+
+  assert g.alphabet == b'0123456789'
+  assert all(g.generate().isdigit() for i in range(20))
+
+def test_string_generator14():
+  g = StringGenerator(min_length=4, max_length=4, max_letters=0, max_numbers=0,
+    max_symbols=0)
+
+  assert g.generate() == False
+  assert StringGenerator(min_length=4, max_length=4, max_letters=0, max_numbers=0,
+    max_symbols=0, max_run=1).generate() == False
+
+def test_string_generator15():
+  # after STRUCTURED_PICKS rejected picks, the pick comes from the
+  # characters that are still allowed ('a' is first, so 'b' is next)
+  g = StringGenerator(min_length=2, max_length=2, max_run=1)
+  buf = bytearray(2)
+
+  assert g._structured_fill(ScriptedEntropy('a' * (STRUCTURED_PICKS + 2)), buf, 2)
+  assert buf == b'ab'
+
+def test_string_generator16():
+  n = len(character_classes['characters'])
+  g = StringGenerator(min_length=n, max_length=n, max_identical=1, tries=1)
+
+  assert all(sorted(g.generate()) == sorted(character_classes['characters'])
+    for i in range(20))
+
+def test_generate_acceptable_string8():
+  s = generate_acceptable_string(min_length=16, max_length=16, max_run=1)
+
+  assert longest_run(s) == 1
+
+
+def wait_for(condition):
+  for i in range(500):
+    if condition():
+      return True
+    time.sleep(0.01)
+  return False
+
+def test_string_reservoir1():
+  with StringReservoir(StringGenerator(min_length=12, max_length=12), 2, 8) as r:
+    assert wait_for(lambda: len(r) == 8)
+    s = r.pop()
+
+    assert len(s) == 12
+    assert r.stats()['hits'] == 1
+
+def test_string_reservoir2():
+  with StringReservoir(StringGenerator(min_length=8, max_length=8), 2, 8) as r:
+    assert wait_for(lambda: len(r) == 8)
+    for i in range(7):
+      r.pop()
+
+    assert wait_for(lambda: r.stats()['refills'] >= 2 and len(r) == 8)
+
+def test_string_reservoir3():
+  with StringReservoir(StringGenerator(min_length=3, max_length=3, min_letters=4), 1, 2) as r:
+    assert r.pop() == False
+    assert r.stats()['misses'] == 1
+
+def test_string_reservoir4():
+  r = StringReservoir(StringGenerator(min_length=8, max_length=8), 1, 4)
+  r.close()
+
+  assert len(r) == 0
+  assert r.pop() != False
+  assert r.stats()['hit_rate'] == 0.0
+
+def test_string_reservoir5():
+  with pytest.raises(ValueError):
+    StringReservoir(StringGenerator(), 4, 4)
+
+def test_string_reservoir6():
+  g = StringGenerator(min_length=10, max_length=10, min_numbers=1)
+  results = []
+  with StringReservoir(g, 16, 64) as r:
+    threads = [threading.Thread(target=lambda: results.extend(r.pop() for i in range(100)))
+      for i in range(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    stats = r.stats()
+
+  assert len(set(results)) == 400
+  assert stats['hits'] + stats['misses'] == 400
+
+
+def test_iter_acceptable_strings1():
+  strings = list(itertools.islice(iter_acceptable_strings(min_length=8, max_length=8,
+    min_numbers=1), 50))
+
+  assert len(strings) == 50
+  assert all(is_acceptable(s, min_length=8, max_length=8, min_numbers=1) for s in strings)
+
+def test_iter_acceptable_strings2():
+  assert list(iter_acceptable_strings(min_length=3, max_length=3, min_letters=4)) == []
+
+def test_iter_acceptable_strings3():
+  it = iter_acceptable_strings(min_length=4, max_length=4)
+
+  assert next(it) != next(it)
+
+def test_iter_acceptable_strings4():
+  assert next(iter_acceptable_strings()) == ''
+
+def test_main_hash2(monkeypatch):
+  monkeypatch.setattr('sys.argv', ['string_generator.py', '-k', '3', '-c', '3', '-C', '3',
+    '-a', '4', '--hash', 'scrypt', '--processes', '1'])
+  with pytest.raises(SystemExit):
+    main()
+
+def test_main_count1(monkeypatch, capsys):
+  monkeypatch.setattr('sys.argv', ['string_generator.py', '-k', '3', '-c', '3', '-C', '3',
+    '-a', '4'])
+  with pytest.raises(SystemExit) as e:
+    main()
+
+  assert e.value.code != 0
+  assert 'False' not in capsys.readouterr().out
+
+def test_main_count2(monkeypatch):
+  monkeypatch.setattr('sys.argv', ['string_generator.py', '--count', '-1', '--hash', 'scrypt'])
+  with pytest.raises(SystemExit):
+    main()
+
+def test_main_hash3(monkeypatch):
+  monkeypatch.setattr('sys.argv', ['string_generator.py', '--hash', 'scrypt',
+    '--processes', '0'])
+  with pytest.raises(SystemExit):
+    main()
+
+
+def test_generate_large_string1():
+  s = generate_large_string(min_length=100000, max_length=100000)
+
+  assert len(s) == 100000
+
+def test_generate_large_string2():
+  s = generate_large_string(min_length=1000, max_length=2000, max_unfriendly=0,
+    min_numbers=1, min_symbols=1)
+
+  assert 1000 <= len(s) <= 2000
+  assert is_acceptable(s, max_unfriendly=0, min_numbers=1, min_symbols=1)
+
+def test_generate_large_string3():
+  s = generate_large_string(min_length=5000, max_length=5000, max_symbols=0,
+    max_numbers=0, chunk_size=7)
+
+  assert len(s) == 5000 and s.isalpha()
+
+def test_generate_large_string4():
+  out = io.BytesIO()
+  assert generate_large_string(stream=out, min_length=70000, max_length=70000,
+    chunk_size=1024) == True
+
+  assert len(out.getvalue()) == 70000
+
+def test_generate_large_string5():
+  assert generate_large_string(min_length=100, max_length=100,
+    min_numbers=101) == False
+
+def test_generate_large_string6():
+  assert generate_large_string() == ''
+
+def test_generate_large_string7():
+  with pytest.raises(ValueError):
+    generate_large_string(min_length=10, max_run=1)
+
+
+def test_stream_unsafe_tests1():
+  assert stream_unsafe_tests(min_length=10, max_length=10, min_numbers=5,
+    max_symbols=3, max_unfriendly=0, min_letters=-1) == ['max_symbols', 'min_numbers']
+
+def test_stream_unsafe_tests2():
+  assert stream_unsafe_tests(min_length=10, max_length=20, max_unfriendly=20,
+    min_unfriendly=0, max_numbers=0) == []
+
+def run_cli(*args):
+  return subprocess.run([sys.executable, 'string_generator.py'] + list(args),
+    cwd=os.path.dirname(os.path.abspath(__file__)),
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+def test_main_stream1():
+  result = run_cli('--stream', '-c', '10', '-C', '10', '-n', '5')
+
+  assert result.returncode != 0
+  assert result.stdout == ''
+  assert 'min_numbers' in result.stderr
+
+def test_main_stream2():
+  result = run_cli('--stream', '-f', '-c', '1000', '-C', '1000')
+
+  assert result.returncode == 0
+  assert is_acceptable(result.stdout.strip(), min_length=1000, max_length=1000, max_unfriendly=0)
+
+def test_main_stream3():
+  for option in (['--count', '3'], ['--hash', 'scrypt'], ['--omit_plaintext'],
+      ['--processes', '2']):
+    result = run_cli('--stream', '-c', '100', '-C', '100', *option)
+
+    assert result.returncode != 0
+    assert result.stdout == ''
+    assert option[0] in result.stderr
+
+def test_count_bytes1():
+  assert count_bytes(b'Test 1 Test!', 'letters') == count('Test 1 Test!', 'letters')
+
+def test_count_bytes2():
+  assert count_bytes(b'Test 1 Test!', 'max_symbols') == count('Test 1 Test!', 'symbols')
+
+def test_random_bytes1():
+  b = random_bytes(10000, 'abc')
+
+  assert len(b) == 10000 and set(b) == set(b'abc')
+
+
+def test_hash_string1():
+  salt, hashed = hash_string('password', salt=b'salt', cost=1)
+
+  assert salt == '73616c74'
+  assert hashed == 'pbkdf2_sha256$1$' + hashlib.pbkdf2_hmac('sha256', b'password', b'salt', 1).hex()
+
+def test_hash_string2():
+  salt, hashed = hash_string('password', 'scrypt', cost=16)
+
+  assert len(salt) == 2 * SALT_BYTES
+  assert hashed.startswith('scrypt$16$8$1$')
+
+def test_hash_string3():
+  with pytest.raises(ValueError):
+    hash_string('password', 'md5')
+
+def test_hash_strings1():
+  strings = ['s%d' % i for i in range(20)]
+  records = list(hash_strings(iter(strings), cost=1, processes=2, queue_size=3))
+
+  assert [r[0] for r in records] == strings
+  assert all(r[2] == hash_string(r[0], salt=bytes.fromhex(r[1]), cost=1)[1] for r in records)
+
+def test_hash_strings2():
+  records = list(hash_strings(['a', 'b'], cost=1, processes=1, include_plaintext=False))
+
+  assert [r[0] for r in records] == [None, None]
+
+def test_hash_strings3():
+  with pytest.raises(ValueError):
+    list(hash_strings(['a'], 'md5'))
+
+def test_write_records1():
+  out = io.StringIO()
+
+  assert write_records([('a', '00', 'h1'), (None, '01', 'h2')], out) == 2
+  assert out.getvalue() == 'a\t00\th1\n\t01\th2\n'
+
+def test_main_hash1(monkeypatch, capsys):
+  monkeypatch.setattr('sys.argv', ['string_generator.py', '-k', '3',
+    '--hash', 'scrypt', '--processes', '1'])
+  main()
+  lines = capsys.readouterr().out.splitlines()
+
+  assert len(lines) == 3
+  assert all(len(line.split('\t')) == 3 for line in lines)
+
+
 def test_shuffle_string1():
   o = 'This is a test'
   n = shuffle_string(o)
@@ -341,6 +808,113 @@ def test_shuffle_string6():
 
   assert count(n, 'length') == count(o, 'length')
 
+def test_shuffle_string7():
+  o = u'café crème'
+  n = shuffle_string(o)
+
+  assert sorted(n) == sorted(o)
+
+
+def test_shuffle_buffer1():
+  o = bytearray(b'This is a test')
+  n = shuffle_buffer(bytearray(o))
+
+  assert sorted(n) == sorted(o)
+
+def test_shuffle_buffer2():
+  b = bytearray(b'This is a test')
+
+  assert shuffle_buffer(b) is b
+
+def test_shuffle_buffer3():
+  o = array.array('i', range(100))
+  n = shuffle_buffer(array.array('i', o))
+
+  assert sorted(n) == list(o)
+
+def test_shuffle_buffer4():
+  assert shuffle_buffer(bytearray()) == bytearray()
+
+def test_shuffle_buffer5():
+  assert shuffle_buffer(bytearray(b'x')) == bytearray(b'x')
+
+def test_shuffle_buffer6():
+  seen = set()
+  for i in range(600):
+    seen.add(bytes(shuffle_buffer(bytearray(b'abc'))))
+
+  assert len(seen) == 6
+
+
+def test_entropy_buffer1():
+  entropy = EntropyBuffer(size=4)
+  values = [entropy.randbelow(6) for i in range(100)]
+
+  assert min(values) >= 0 and max(values) <= 5
+
+def test_entropy_buffer2():
+  entropy = EntropyBuffer(size=4)
+
+  assert len(entropy.words(10)) == 10
+
+def test_entropy_buffer3():
+  entropy = EntropyBuffer()
+
+  assert entropy.randbelow(1) == 0
+
+def test_entropy_buffer4():
+  entropy = EntropyBuffer()
+
+  assert entropy.choice('abc') in 'abc'
+
+def test_entropy_buffer5():
+  entropy = EntropyBuffer()
+  v = entropy.randbelow(1 << 80)
+
+  assert 0 <= v < (1 << 80)
+
+def forked(function):
+  read_end, write_end = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_end)
+    os.write(write_end, function().encode('ascii'))
+    os._exit(0)
+  os.close(write_end)
+  mine = function()
+  with os.fdopen(read_end, 'rb') as f:
+    theirs = f.read().decode('ascii')
+  os.waitpid(pid, 0)
+  return mine, theirs
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork()')
+def test_entropy_buffer_fork1():
+  g = StringGenerator(min_length=16, max_length=16)
+  g.generate()
+  mine, theirs = forked(g.generate)
+
+  assert len(mine) == len(theirs) == 16
+  assert mine != theirs
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork()')
+def test_entropy_buffer_fork2():
+  entropy = EntropyBuffer()
+  entropy.word()
+  mine, theirs = forked(lambda: '%x' % entropy.word())
+
+  assert mine != theirs
+
+def test_default_entropy1():
+  assert default_entropy() is default_entropy()
+
+def test_default_entropy2():
+  other = []
+  t = threading.Thread(target=lambda: other.append(default_entropy()))
+  t.start()
+  t.join()
+
+  assert other[0] is not default_entropy()
+
 
 def test_system_random_range1():
   n = 0
@@ -405,5 +979,258 @@ def test_system_random_range8():
   assert v <= x
 
 
+POLICY = """
+{
+  "profiles": {
+    "pin": {"min_characters": 6, "max_characters": 6, "min_numbers": 2},
+    "db-password": {"min_characters": 32, "max_characters": 20, "friendly": true}
+  }
+}
+"""
+
+def write_policy(tmp_path, text=POLICY, name='policy.json'):
+  path = tmp_path / name
+  path.write_text(text)
+  return str(path)
+
+def test_compile_profile1():
+  assert compile_profile('p', {'min_numbers': 2}) == {'min_numbers': 2}
+
+def test_compile_profile2():
+  assert compile_profile('p', {'min_numbers': 4, 'max_numbers': 2}) == {
+    'min_numbers': 2, 'max_numbers': 4}
+
+def test_compile_profile3():
+  with pytest.raises(ValueError):
+    compile_profile('p', {'min_widgets': 2})
+
+def test_compile_profile4():
+  with pytest.raises(ValueError):
+    compile_profile('p', {'min_numbers': '2'})
+
+def test_compile_profile5():
+  with pytest.raises(ValueError):
+    compile_profile('p', {'min_numbers': True})
+
+def test_compile_profile6():
+  with pytest.raises(ValueError):
+    compile_profile('p', {'friendly': 1})
+
+def test_compile_profile7():
+  assert compile_profile('p', {'min_numbers': 2, 'max_numbers': -1}) == {
+    'min_numbers': 2, 'max_numbers': -1}
+
+def test_compile_policy1():
+  with pytest.raises(ValueError):
+    compile_policy({'pin': {}})
+
+def test_load_policy1(tmp_path):
+  profiles = load_policy(write_policy(tmp_path), cache_dir=str(tmp_path / 'cache'))
+
+  assert profiles['pin']['min_numbers'] == 2
+  assert profiles['db-password']['min_characters'] == 20
+
+def test_load_policy2(tmp_path, monkeypatch):
+  path = write_policy(tmp_path)
+  cache_dir = str(tmp_path / 'cache')
+  load_policy(path, cache_dir=cache_dir)
+
+  import string_generator
+  def fail(policy):
+    raise AssertionError('policy was compiled again')
+  monkeypatch.setattr(string_generator, 'compile_policy', fail)
+
+  assert load_policy(path, cache_dir=cache_dir)['pin']['max_characters'] == 6
+
+def test_load_policy3(tmp_path):
+  path = write_policy(tmp_path)
+  cache_dir = str(tmp_path / 'cache')
+  load_policy(path, cache_dir=cache_dir)
+  write_policy(tmp_path, POLICY.replace('"min_numbers": 2', '"min_numbers": 3'))
+
+  assert load_policy(path, cache_dir=cache_dir)['pin']['min_numbers'] == 3
+
+def test_load_policy4(tmp_path):
+  with pytest.raises(ValueError):
+    load_policy(write_policy(tmp_path, '{"profiles": '), cache_dir=str(tmp_path))
+
+def test_load_policy5(tmp_path):
+  pytest.importorskip('tomllib')
+  path = write_policy(tmp_path, '[profiles.pin]\nmin_numbers = 4\n', 'policy.toml')
+
+  assert load_policy(path, cache_dir=str(tmp_path / 'cache')) == {'pin': {'min_numbers': 4}}
+
+def test_load_policy6(tmp_path):
+  cache_dir = tmp_path / 'cache'
+  load_policy(write_policy(tmp_path), cache_dir=str(cache_dir))
+
+  assert os.stat(str(cache_dir)).st_mode & 0o777 == 0o700
+  assert len(os.listdir(str(cache_dir))) == 1
+
+def test_load_policy7(tmp_path, monkeypatch):
+  # a cache directory others can write to is neither read nor written
+  path = write_policy(tmp_path)
+  cache_dir = tmp_path / 'cache'
+  load_policy(path, cache_dir=str(cache_dir))
+  os.chmod(str(cache_dir), 0o777)
+
+  import string_generator
+  compiled = []
+  original = string_generator.compile_policy
+  monkeypatch.setattr(string_generator, 'compile_policy',
+    lambda policy: compiled.append(policy) or original(policy))
+
+  assert load_policy(path, cache_dir=str(cache_dir))['pin']['min_numbers'] == 2
+  assert len(compiled) == 1
+
+def test_load_policy8(tmp_path, monkeypatch):
+  # a cache file that belongs to someone else is ignored
+  if not hasattr(os, 'geteuid') or os.geteuid() != 0:
+    pytest.skip('changing file ownership needs root')
+  path = write_policy(tmp_path)
+  cache_dir = tmp_path / 'cache'
+  load_policy(path, cache_dir=str(cache_dir))
+  for name in os.listdir(str(cache_dir)):
+    os.chown(str(cache_dir / name), os.getuid() + 1, -1)
+
+  import string_generator
+  compiled = []
+  original = string_generator.compile_policy
+  monkeypatch.setattr(string_generator, 'compile_policy',
+    lambda policy: compiled.append(policy) or original(policy))
+
+  assert load_policy(path, cache_dir=str(cache_dir))['pin']['min_numbers'] == 2
+  assert len(compiled) == 1
+
+def test_load_policy9(tmp_path, monkeypatch):
+  cache_dir = tmp_path / 'cache'
+  def fail(source, destination):
+    raise OSError('replace failed')
+  monkeypatch.setattr('os.replace', fail)
+
+  assert load_policy(write_policy(tmp_path), cache_dir=str(cache_dir))['pin']['min_numbers'] == 2
+  assert os.listdir(str(cache_dir)) == []
+
+def test_profile_kwargs1():
+  kwargs = profile_kwargs({'min_characters': 6, 'max_characters': 6, 'friendly': True})
+
+  assert kwargs['min_length'] == 6 and kwargs['max_length'] == 6
+  assert kwargs['max_unfriendly'] == 0
+
+def test_main_profile1(tmp_path, monkeypatch, capsys):
+  monkeypatch.setenv('STRING_GENERATOR_CACHE', str(tmp_path / 'cache'))
+  monkeypatch.setattr('sys.argv', ['string_generator.py',
+    '--policy_file', write_policy(tmp_path), '--profile', 'pin'])
+  main()
+  s = capsys.readouterr().out.strip()
+
+  assert len(s) == 6 and count(s, 'numbers') >= 2
+
+def test_main_profile2(tmp_path, monkeypatch, capsys):
+  monkeypatch.setenv('STRING_GENERATOR_CACHE', str(tmp_path / 'cache'))
+  monkeypatch.setattr('sys.argv', ['string_generator.py',
+    '--policy_file', write_policy(tmp_path), '--profile', 'pin', '-C', '8'])
+  main()
+  s = capsys.readouterr().out.strip()
+
+  assert 6 <= len(s) <= 8
+
+def test_main_profile3(tmp_path, monkeypatch):
+  monkeypatch.setattr('sys.argv', ['string_generator.py',
+    '--policy_file', write_policy(tmp_path), '--profile', 'nope'])
+  with pytest.raises(SystemExit):
+    main()
+
+def readme_policy():
+  readme = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'README.md')
+  with open(readme) as f:
+    text = f.read()
+  text = text[text.index('### Profiles'):]
+  return text[text.index('```json') + len('```json'):text.index('```', text.index('```json') + 1)]
+
+def test_main_profile4(tmp_path, monkeypatch, capsys):
+  # every profile documented in the README has to actually work
+  path = write_policy(tmp_path, readme_policy())
+  monkeypatch.setenv('STRING_GENERATOR_CACHE', str(tmp_path / 'cache'))
+  for name, options in load_policy(path).items():
+    monkeypatch.setattr('sys.argv', ['string_generator.py',
+      '--policy_file', path, '--profile', name, '--count', '20'])
+    main()
+    strings = capsys.readouterr().out.split()
+
+    assert len(strings) == 20
+    assert all(is_acceptable(s, **profile_kwargs(options)) for s in strings), name
+
+
+# how long 'import string_generator' may take (in microseconds) once its
+# bytecode is cached, as reported by python -X importtime
+IMPORT_TIME_BUDGET = int(os.environ.get('STRING_GENERATOR_IMPORT_BUDGET', 5000))
+
+def import_times(pycache, *args):
+  env = dict(os.environ)
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+  result = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-X', 'pycache_prefix=' + str(pycache)] + list(args),
+    cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  times = {}
+  for line in result.stderr.splitlines():
+    fields = line.replace('import time:', '').split('|')
+    if len(fields) == 3 and fields[1].strip().isdigit():
+      times[fields[2].strip()] = int(fields[1])
+  return times, result.stdout
+
+def test_import_time1(tmp_path):
+  import_times(tmp_path, '-c', 'import string_generator')
+  best = min(import_times(tmp_path, '-c', 'import string_generator')[0]['string_generator']
+    for i in range(3))
+
+  assert best < IMPORT_TIME_BUDGET
+
+def test_import_time2(tmp_path):
+  times, out = import_times(tmp_path, '-c', 'import string_generator')
+
+  for module in ('argparse', 'random', 're', 'string', 'threading', 'collections'):
+    assert module not in times
+
+def test_import_time3(tmp_path):
+  times, out = import_times(tmp_path, 'string_generator.py')
+
+  assert 8 <= len(out.strip()) <= 16
+  assert 'argparse' not in times
+
+def test_import_fallback1():
+  # without _thread._local, the pure-Python threading.local is used
+  result = subprocess.run([sys.executable, '-c',
+    'import _thread; del _thread._local; import string_generator; '
+    'print(string_generator._thread_local.__module__); '
+    'print(string_generator.StringGenerator(min_length=8, max_length=8).generate())'],
+    cwd=os.path.dirname(os.path.abspath(__file__)),
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  module, s = result.stdout.split()
+
+  assert module == '_threading_local'
+  assert len(s) == 8
+
+def test_character_classes1():
+  import string
+  assert character_classes['characters'] == (string.ascii_letters + string.digits
+    + string.punctuation.replace('"', '').replace("'", '').replace('`', ''))
+
+def test_main_defaults1():
+  args = build_parser().parse_args([])
+  options = dict((option, getattr(args, option)) for option in policy_options)
+
+  assert profile_kwargs(options) == dict(profile_kwargs({}), **dict(
+    (test, -1) for test in profile_kwargs(options) if test not in profile_kwargs({})))
+
+def test_main_defaults2(monkeypatch, capsys):
+  monkeypatch.setattr('sys.argv', ['string_generator.py'])
+  main()
+  s = capsys.readouterr().out.strip()
+
+  assert 8 <= len(s) <= 16
+
+
 if __name__ == '__main__':
     pytest.main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+## @file test_string_generator_bias.py
+#  @brief statistical tests for bias in the strings string_generator.py makes
+#  @details
+#  Each test generates a large sample for one set of tests (a "policy")
+#  and compares what came out against what a perfectly uniform generator
+#  would produce, using a chi-square test.  The thresholds are set at a
+#  one-in-a-million false alarm rate, so a failure means bias, not bad
+#  luck.  Counting is done over whole byte strings with collections.Counter
+#  and slicing (both in C), so millions of samples stay cheap.
+#
+#  The sample size defaults to something quick enough for every test run;
+#  set STRING_GENERATOR_SAMPLES (or run this file directly with a number)
+#  to check millions of strings and see how long each check takes:
+#  @code
+#  python test_string_generator_bias.py 1000000
+#  @endcode
+
+
+import os
+import sys
+import math
+import itertools
+import collections
+import statistics
+
+import pytest
+import string_generator
+from string_generator import *
+
+SAMPLES = int(os.environ.get('STRING_GENERATOR_SAMPLES', 20000))
+
+# z-score for a one-sided one-in-a-million false alarm rate
+Z = statistics.NormalDist().inv_cdf(1 - 1e-6)
+
+ALPHABET = character_classes['characters'].encode('ascii')
+
+
+## @fn critical()
+#  @brief the chi-square value a uniform generator stays under
+#  @details
+#  Uses the Wilson-Hilferty approximation to the chi-square quantile,
+#  which is plenty accurate for the degrees of freedom used here.
+def critical(df):
+  h = 2.0 / (9 * df)
+  return df * (1 - h + Z * math.sqrt(h)) ** 3
+
+
+## @fn chi_square()
+#  @brief compare observed counts against expected counts
+#  @details
+#  Bins whose expected count is under 5 are merged so the test is valid.
+#  @returns Tuple (statistic, degrees of freedom)
+def chi_square(observed, expected):
+  bins = []
+  o = e = 0
+  for key in sorted(expected, key=lambda k: -expected[k]):
+    o += observed.get(key, 0)
+    e += expected[key]
+    if e >= 5:
+      bins.append((o, e))
+      o = e = 0
+  if e and bins:
+    last_o, last_e = bins.pop()
+    bins.append((last_o + o, last_e + e))
+  unexpected = sum(n for key, n in observed.items() if key not in expected)
+  assert unexpected == 0, 'produced values that should be impossible'
+  return sum((o - e) ** 2 / e for o, e in bins), len(bins) - 1
+
+
+def assert_uniform(observed, population, n):
+  expected = dict((key, float(n) / len(population)) for key in population)
+  statistic, df = chi_square(observed, expected)
+  assert statistic < critical(df), (statistic, critical(df))
+
+
+def sample(generator, n=SAMPLES):
+  return [generator.generate() for i in range(n)]
+
+
+#
+# the raw sources of randomness
+#
+
+
+def test_randbelow_unbiased():
+  # with a bound this close to 2 ** 32, taking the word modulo the bound
+  # would make the bottom third of the range twice as likely
+  bound = 3 << (string_generator._WORD_BITS - 2)
+  entropy = EntropyBuffer()
+  n = SAMPLES * 10
+  low = sum(1 for i in range(n) if entropy.randbelow(bound) < bound // 3)
+  expected = n / 3.0
+  statistic = (low - expected) ** 2 / expected + (low - expected) ** 2 / (n - expected)
+
+  assert statistic < critical(1)
+
+def test_shuffle_permutations_uniform():
+  observed = collections.Counter(
+    bytes(shuffle_buffer(bytearray(b'abcd'))) for i in range(SAMPLES))
+  permutations = [bytes(p) for p in itertools.permutations(b'abcd')]
+
+  assert_uniform(observed, permutations, SAMPLES)
+
+def test_random_bytes_uniform():
+  n = SAMPLES * 50
+  observed = collections.Counter(random_bytes(n, character_classes['characters']))
+
+  assert_uniform(observed, ALPHABET, n)
+
+
+#
+# unconstrained strings
+#
+
+
+def test_characters_uniform():
+  data = ''.join(sample(StringGenerator(min_length=16, max_length=16))).encode('ascii')
+
+  assert_uniform(collections.Counter(data), ALPHABET, len(data))
+
+def test_positions_uniform():
+  length = 16
+  data = ''.join(sample(StringGenerator(min_length=length, max_length=length))).encode('ascii')
+  for position in range(length):
+    column = data[position::length]
+    assert_uniform(collections.Counter(column), ALPHABET, len(column))
+
+def test_transitions_uniform():
+  length = 16
+  strings = sample(StringGenerator(min_length=length, max_length=length))
+  data = ''.join(strings).encode('ascii')
+  observed = collections.Counter()
+  for position in range(length - 1):
+    observed.update(zip(data[position::length], data[position + 1::length]))
+  pairs = list(itertools.product(ALPHABET, ALPHABET))
+
+  assert_uniform(observed, pairs, len(strings) * (length - 1))
+
+def test_lengths_uniform():
+  # system_random_range() used to round(), making 8 and 16 half as likely
+  observed = collections.Counter(
+    len(s) for s in sample(StringGenerator(min_length=8, max_length=16)))
+
+  assert_uniform(observed, range(8, 17), SAMPLES)
+
+
+#
+# constrained strings
+#
+
+
+def test_friendly_characters_uniform():
+  friendly = bytes(bytearray(b for b in ALPHABET if not is_unfriendly(chr(b))))
+  data = ''.join(sample(StringGenerator(min_length=16, max_length=16,
+    max_unfriendly=0))).encode('ascii')
+
+  assert_uniform(collections.Counter(data), friendly, len(data))
+
+def test_class_counts_match_theory():
+  # with min_numbers=2 and max_symbols=3, an unbiased generator makes
+  # every acceptable string equally likely, so the number of digits
+  # follows a multinomial distribution conditioned on the tests
+  length = 12
+  digits = len([c for c in ALPHABET if chr(c).isdigit()])
+  symbols = len([c for c in ALPHABET if is_symbol(chr(c))])
+  others = len(ALPHABET) - digits - symbols
+
+  weights = {}
+  for n in range(2, length + 1):
+    for s in range(0, min(3, length - n) + 1):
+      ways = (math.comb(length, n) * math.comb(length - n, s)
+        * digits ** n * symbols ** s * others ** (length - n - s))
+      weights[n] = weights.get(n, 0) + ways
+  total = sum(weights.values())
+
+  strings = sample(StringGenerator(min_length=length, max_length=length,
+    min_numbers=2, max_symbols=3))
+  observed = collections.Counter(count(s, 'numbers') for s in strings)
+  expected = dict((n, float(w) * len(strings) / total) for n, w in weights.items())
+  statistic, df = chi_square(observed, expected)
+
+  assert statistic < critical(df), (statistic, critical(df))
+
+def test_structural_transitions():
+  # position-aware picking must never produce a forbidden successor
+  # and must pick evenly among the allowed ones
+  length = 16
+  strings = sample(StringGenerator(min_length=length, max_length=length, max_run=1))
+  data = ''.join(strings).encode('ascii')
+  observed = collections.Counter()
+  for position in range(length - 1):
+    observed.update(zip(data[position::length], data[position + 1::length]))
+  pairs = [(a, b) for a, b in itertools.product(ALPHABET, ALPHABET) if a != b]
+
+  assert_uniform(observed, pairs, len(strings) * (length - 1))
+
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1:
+    os.environ['STRING_GENERATOR_SAMPLES'] = sys.argv[1]
+  sys.exit(pytest.main([__file__, '-q', '--durations=0']))